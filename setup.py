@@ -84,7 +84,7 @@ setup(
         "netCDF4>=1.1.1",
         "numba",
         "numexpr",
-        "numpy>=1.13",
+        "numpy>=1.17",
         "pandas",
         "scikit-image",
         "scikit-learn",
@@ -13,14 +13,21 @@
 import sys
 import abc
 import dbm
+import functools
 import logging
 import tempfile
 import pathlib
 import shutil
 import datetime
 import warnings
+import collections
+import concurrent.futures
 
 import numpy
+try:
+    import numba
+except ImportError:
+    numba = None
 try:
     import progressbar
 except ImportError:
@@ -40,41 +47,150 @@ class OutlierFilter(metaclass=abc.ABCMeta):
     def filter_outliers(self, C):
         ...
 
+def _nanfilled(C, dtype=None):
+    """Channel-first floating point copy of 2-D C, masked set to NaN
+
+    Returns a C-contiguous array of shape (C.shape[1], C.shape[0]), such
+    that the samples for each channel are contiguous in memory.  Unless
+    dtype is given, floating point input keeps its precision and
+    anything else becomes float64.
+    """
+    data = numpy.ma.getdata(C).T
+    if dtype is None:
+        dtype = data.dtype if data.dtype.kind == "f" else numpy.float64
+    A = numpy.empty(data.shape, dtype=dtype)
+    A[...] = data
+    mask = numpy.ma.getmask(C)
+    if mask is not numpy.ma.nomask:
+        numpy.copyto(A, numpy.nan, where=mask.T)
+    return A
+
+def _mad_outliers_numpy(A, cutoff, fallback_min_std, out):
+    """Flag MAD outliers in each row of A, writing to out
+
+    Implementation of MEDMAD.filter_outliers for a 2-D array with one
+    channel per row and masked values set to NaN.  numpy.nanmedian
+    partitions rather than sorts, unlike numpy.ma.median.  Masked values
+    are flagged.  Channels that are entirely masked are flagged without
+    computing anything else.
+    """
+    for (row, rowout) in zip(A, out):
+        masked = numpy.isnan(row)
+        if masked.all():
+            rowout[...] = True
+            continue
+        med = numpy.nanmedian(row)
+        dev = row - med
+        numpy.abs(dev, out=dev)
+        mad = numpy.nanmedian(dev)
+        if mad == 0:
+            # use fallback
+            med = numpy.nanmean(row)
+            mad = max(numpy.nanstd(row), fallback_min_std)
+            numpy.subtract(row, med, out=dev)
+            numpy.abs(dev, out=dev)
+        # fractional deviation, divided in-place; NaN compares false
+        dev /= mad
+        numpy.greater(dev, cutoff, out=rowout)
+        rowout |= masked
+
+if numba is None:
+    _mad_outliers = _mad_outliers_numpy
+else:
+    @numba.njit(cache=True)
+    def _mad_outliers(A, cutoff, fallback_min_std, out):
+        """Flag MAD outliers in each row of A, writing to out
+
+        Numba implementation of MEDMAD.filter_outliers for a 2-D array
+        with one channel per row and masked values set to NaN.  Masked
+        values are flagged.  Rows are processed serially: a parallel
+        kernel would make MEDMAD unsafe to call from several threads with
+        Numba's default threading layer, and there are few channels to
+        spread over anyway.  The first
+        call for each dtype compiles the kernel, which takes several
+        seconds unless Numba's on-disk cache can be used.
+        """
+        (nchan, n) = A.shape
+        for k in range(nchan):
+            row = A[k]
+            valid = numpy.empty(n, dtype=A.dtype)
+            m = 0
+            for i in range(n):
+                if not numpy.isnan(row[i]):
+                    valid[m] = row[i]
+                    m += 1
+            if m == 0:
+                out[k, :] = True
+            else:
+                valid = valid[:m]
+                med = numpy.median(valid)
+                mad = numpy.median(numpy.abs(valid - med))
+                if mad == 0:
+                    # use fallback
+                    med = valid.mean()
+                    mad = max(valid.std(), fallback_min_std)
+                for i in range(n):
+                    out[k, i] = (numpy.isnan(row[i]) or
+                                 abs(row[i] - med) / mad > cutoff)
+
 class MEDMAD(OutlierFilter):
     """Outlier filter based on Median Absolute Deviation
 
+    Arguments:
+
+        cutoff [float]
+
+            Number of MADs from the median beyond which an element is
+            an outlier.
+
+        fallback_min_std [float]
+
+            Minimum standard deviation to use where the MAD is zero.
+
+        precision [str or None]
+
+            Floating point precision for the computation, "f32" or
+            "f64".  "f32" halves memory traffic and is precise enough
+            for counts and temperatures at typical cutoffs.  Defaults to
+            None, which keeps floating point input as it is and uses
+            float64 for anything else.
     """
 
-    def __init__(self, cutoff, fallback_min_std=0.1):
+    _precisions = {None: None, "f32": numpy.float32, "f64": numpy.float64}
+
+    def __init__(self, cutoff, fallback_min_std=0.1, precision=None):
+        if precision not in self._precisions:
+            raise ValueError("Unknown precision {!r}, expected one of "
+                "{!s}".format(precision, list(self._precisions)))
         self.cutoff = cutoff
-        self.fallback_min_std = 0.1
+        self.fallback_min_std = fallback_min_std
+        self.precision = precision
     
     def filter_outliers(self, C):
-        cutoff = self.cutoff
-        if C.ndim == 3:
-            med = numpy.ma.median(
-                C.reshape(C.shape[0]*C.shape[1], C.shape[2]),
-                0)
-            mad = numpy.ma.median(
-                abs(C - med).reshape(C.shape[0]*C.shape[1], C.shape[2]),
-                0)
-            if (mad==0).any():
-                # use fallback
-                med[mad==0] = C[..., mad==0].reshape(C.shape[0]*C.shape[1], (mad==0).sum()).mean(0)
-                mad[mad==0] = numpy.c_[
-                    C[..., mad==0].reshape(C.shape[0]*C.shape[1], (mad==0).sum()).std(0),
-                    numpy.tile(self.fallback_min_std, (mad==0).sum())].max(1)
-        elif C.ndim < 3:
-            med = numpy.ma.median(C.reshape((-1,)))
-            mad = numpy.ma.median(abs(C - med).reshape((-1,)))
-            if mad==0:
-                med = C.mean()
-                mad = max(C.std(), self.fallback_min_std)
-        else:
+        """Flag elements deviating more than cutoff MADs from the median
+
+        For 3-D input, the median and MAD are taken per element of the
+        last dimension; otherwise, over all elements.  Where the MAD is
+        zero, the mean and standard deviation (at least
+        fallback_min_std) are used instead.  Masked elements are flagged
+        as outliers.
+
+        Arguments:
+
+            C [ndarray or MaskedArray], at most 3 dimensions
+
+        Returns:
+
+            Boolean ndarray with the same shape as C.
+        """
+        if C.ndim > 3:
             raise ValueError("Cannot filter outliers on "
                 "input with ndim={ndim:d}>3 dimensions".format(ndim=C.ndim))
-        fracdev = ((C - med)/mad)
-        return abs(fracdev) > cutoff
+        A = _nanfilled(C.reshape(-1, C.shape[2] if C.ndim == 3 else 1),
+                       self._precisions[self.precision])
+        out = numpy.empty(A.shape, dtype="?")
+        _mad_outliers(A, self.cutoff, self.fallback_min_std, out)
+        return out.T.reshape(C.shape)
 
 class OrbitFilter:
     """Generic, abstract class for any kind of filtering.
@@ -297,6 +413,13 @@ class OverlapFilter(OrbitFilter):
     late = False
 
 class FirstlineDBFilter(OverlapFilter):
+    # when updating, synchronise the database to disk after this many
+    # new entries, so that an interrupted update keeps most of its work
+    sync_every = 1000
+    # read the firstline database entirely into memory if it has at most
+    # this many entries (roughly 50 MB)
+    max_preload = 200000
+
     def __init__(self, ds, granules_firstline_file):
         self.ds = ds
         self.granules_firstline_file = granules_firstline_file
@@ -306,41 +429,107 @@ class FirstlineDBFilter(OverlapFilter):
 
     _tmpdir = None
     _firstline_db = None
+    _firstline_cache = None
+    _firstline_map = None
     def filter(self, scanlines, header):
         """Filter out any scanlines that existed in the previous granule.
 
         Only works on datasets implementing get_dataname from the header.
         """
         dataname = self.ds.get_dataname(header, robust=True)
-        if self._firstline_db is None:
-            try:
-                self._firstline_db = dbm.open(
-                    str(self.granules_firstline_file), "r")
-            except dbm.error as e: # presumably a lock
-                tmpdir = tempfile.TemporaryDirectory()
-                self._tmpdir = tmpdir # should be deleted only when object is
-                tmp_gfl = str(pathlib.Path(tmpdir.name,
-                    self.granules_firstline_file.name))
-                logger.warning("Cannot read GFL DB at {!s}: {!s}, "
-                    "presumably in use, copying to {!s}".format(
-                        self.granules_firstline_file, e.args, tmp_gfl))
-                shutil.copyfile(str(self.granules_firstline_file),
-                    tmp_gfl)
-                self.granules_firstline_file = tmp_gfl
-                self._firstline_db = dbm.open(tmp_gfl)
+        if self._firstline_db is None and self._firstline_map is None:
+            self._load_firstline_db()
         try:
-            firstline = int(self._firstline_db[dataname])
+            if self._firstline_map is not None:
+                firstline = self._firstline_map[dataname]
+            else:
+                firstline = self._firstline_cache(dataname)
         except KeyError as e:
             raise FilterError("Unable to filter firstline: {:s}".format(
-                e.args[0])) from e
+                dataname)) from e
         if firstline > scanlines.shape[0]:
             logger.warning("Full granule {:s} appears contained in previous one. "
                 "Refusing to return any lines.".format(dataname))
             return scanlines[0:0]
-        return scanlines[scanlines["hrs_scnlin"] > firstline]    
+        scnlin = numpy.ma.getdata(scanlines["hrs_scnlin"])
+        # This filter runs before HIRSTimeSequenceDuplicateFilter, so
+        # order is not guaranteed; when sorted, as is usual, slice rather
+        # than build a boolean index.  Copy, because scanlines may be the
+        # cached result of Dataset.read and later filters write masks in
+        # place.
+        if (scnlin[1:] >= scnlin[:-1]).all():
+            return scanlines[numpy.searchsorted(scnlin, firstline,
+                                                side="right"):].copy()
+        return scanlines[scnlin > firstline]
+
+    def _load_firstline_db(self):
+        """Open firstline database for reading
+
+        If it has at most max_preload entries, read it entirely into
+        memory and close it again.  Otherwise, keep it open for per-key
+        lookups.
+        """
+        try:
+            self._firstline_db = dbm.open(
+                str(self.granules_firstline_file), "r")
+        except dbm.error as e: # presumably a lock
+            tmpdir = tempfile.TemporaryDirectory()
+            self._tmpdir = tmpdir # should be deleted only when object is
+            tmp_gfl = str(pathlib.Path(tmpdir.name,
+                self.granules_firstline_file.name))
+            logger.warning("Cannot read GFL DB at {!s}: {!s}, "
+                "presumably in use, copying to {!s}".format(
+                    self.granules_firstline_file, e.args, tmp_gfl))
+            shutil.copyfile(str(self.granules_firstline_file),
+                tmp_gfl)
+            self.granules_firstline_file = tmp_gfl
+            self._firstline_db = dbm.open(tmp_gfl)
+        if len(self._firstline_db) <= self.max_preload:
+            self._firstline_map = {k.decode(): int(self._firstline_db[k])
+                for k in self._firstline_db.keys()}
+            self._firstline_db.close()
+            self._firstline_db = None
+        else:
+            # per instance, as filters are unhashable (see __eq__)
+            self._firstline_cache = functools.lru_cache(maxsize=4096)(
+                self._lookup_firstline)
+
+    def _lookup_firstline(self, dataname):
+        """Read firstline for dataname from the opened database
+        """
+        return int(self._firstline_db[dataname])
+
+    def _read_ahead(self, granules, max_workers):
+        """Yield (g_start, gran, read) with granules read in threads
+
+        Calling read() returns what self.ds.read returns.  If max_workers
+        is None, read() reads the granule when called.  Otherwise, reads
+        are submitted to that many threads in order, at most max_workers
+        ahead of the granule being yielded, so that only that many are
+        kept in memory.  Threaded reads bypass the cache of
+        Dataset.read, which is not thread-safe and would not be hit
+        anyway, as each granule is read once.
+        """
+        if max_workers is None:
+            for (g_start, gran) in granules:
+                yield (g_start, gran, functools.partial(self.ds.read, gran,
+                    apply_scale_factors=False, calibrate=False))
+            return
+        queue = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers) as executor:
+            for (g_start, gran) in granules:
+                queue.append((g_start, gran,
+                    executor.submit(self.ds.read, gran,
+                        apply_scale_factors=False, calibrate=False,
+                        NO_CACHE=True).result))
+                if len(queue) > max_workers:
+                    yield queue.popleft()
+            while queue:
+                yield queue.popleft()
 
     def update_firstline_db(self, satname=None, start_date=None, end_date=None,
-            overwrite=False):
+            overwrite=False, max_workers=None):
         """Create / update the firstline database
 
         Create or update the database describing for each granule what the
@@ -348,8 +537,12 @@ class FirstlineDBFilter(OverlapFilter):
 
         If a granule is entirely contained within the previous one,
         firstline is set to L+1 where L is the number of lines.
+
+        If max_workers is given, granules are read ahead in that many
+        threads while the previous one is compared.  By default, granules
+        are read one by one.
         """
-        prev_head = prev_line = None
+        prev_dataname = prev_time_max = None
         satname = satname or self.ds.satname
         start_date = start_date or self.ds.start_date
         end_date = end_date or self.ds.end_date
@@ -358,6 +551,7 @@ class FirstlineDBFilter(OverlapFilter):
         logger.info("Updating firstline-db {:s} for "
             "{:%Y-%m-%d}--{:%Y-%m-%d}".format(satname, start_date, end_date))
         count_updated = count_all = 0
+        period = end_date - start_date
         with dbm.open(str(self.granules_firstline_file), "c") as gfd:
             try:
                 bar = progressbar.ProgressBar(max_value=1,
@@ -376,13 +570,15 @@ class FirstlineDBFilter(OverlapFilter):
                 if dobar:
                     bar.start()
                     bar.update(0)
-            for (g_start, gran) in self.ds.find_granules_sorted(start_date, end_date,
-                            return_time=True, satname=satname):
+            for (g_start, gran, read) in self._read_ahead(
+                    self.ds.find_granules_sorted(start_date, end_date,
+                            return_time=True, satname=satname),
+                    max_workers):
                 try:
-                    (cur_line, extra) = self.ds.read(gran,
-                        apply_scale_factors=False, calibrate=False)
+                    (cur_line, extra) = read()
                     cur_head = extra["header"]
                     cur_time = self.ds._get_time(cur_line)
+                    cur_time_max = cur_time.max()
                 except (dataset.InvalidFileError,
                         dataset.InvalidDataError) as exc:
                     logger.error("Could not read {!s}: {!s}".format(gran, exc))
@@ -390,11 +586,11 @@ class FirstlineDBFilter(OverlapFilter):
                 lab = self.ds.get_dataname(cur_head, robust=True)
                 if lab in gfd and not overwrite:
                     logger.debug("Already present: {:s}".format(lab))
-                elif prev_line is not None:
-                    # what if prev_line is None?  We don't want to define any
-                    # value for the very first granule we process, as we might
-                    # be starting to process in the middle...
-                    if cur_time.max() > prev_time.max():
+                elif prev_time_max is not None:
+                    # what if there is no previous granule?  We don't want to
+                    # define any value for the very first granule we process,
+                    # as we might be starting to process in the middle...
+                    if cur_time_max > prev_time_max:
                         # Bugfix 2017-01-16: do not get confused between
                         # the index and the hrs_scnlin field.  So far, I'm using
                         # the index to set firstline but the hrs_scnlin
@@ -404,24 +600,49 @@ class FirstlineDBFilter(OverlapFilter):
                         # time from the previous granule, take the
                         # maximum; this allows for time sequence errors.
                         # See #139
-                        first = cur_line["hrs_scnlin"][cur_time > prev_time.max()].min()
-                        logger.debug("{:s}: {:d}".format(lab, first))
+                        # Reduce with where= rather than indexing a copy;
+                        # masked scanline numbers are skipped as before.
+                        scnlin = cur_line["hrs_scnlin"]
+                        later = numpy.ma.getdata(cur_time > prev_time_max)
+                        later &= ~numpy.ma.getmaskarray(scnlin)
+                        if later.any():
+                            # where= needs initial, but it is never the
+                            # result as at least one element is reduced
+                            first = numpy.min(numpy.ma.getdata(scnlin),
+                                where=later,
+                                initial=numpy.iinfo(scnlin.dtype).max)
+                            logger.debug("{:s}: {:d}".format(lab, first))
+                        else:
+                            first = None
+                            logger.error("{:s}: all scanline numbers after "
+                                "{:s} are masked, not storing firstline".format(
+                                    lab, prev_dataname))
                     else:
                         first = cur_line["hrs_scnlin"].max()+1
                         logger.info("{:s}: Fully contained in {:s}!".format(
-                            lab, self.ds.get_dataname(prev_head, robust=True)))
-                    gfd[lab] = str(first)
-                    count_updated += 1
-                prev_line = cur_line.copy()
-                prev_head = cur_head.copy()
-                prev_time = cur_time.copy()
-                if dobar:
-                    bar.update((g_start-start_date)/(end_date-start_date))
+                            lab, prev_dataname))
+                    if first is not None:
+                        gfd[lab] = str(first)
+                        count_updated += 1
+                        if (count_updated % self.sync_every == 0
+                                and hasattr(gfd, "sync")):
+                            gfd.sync()
+                # only the latest time and the dataname are needed for
+                # the next granule, no need to keep a copy of the data
+                prev_time_max = cur_time_max
+                prev_dataname = lab
+                # redrawing for every granule can cost more than the
+                # granule itself
+                if dobar and count_all % 64 == 0:
+                    bar.update((g_start-start_date)/period)
                 count_all += 1
             if dobar:
                 bar.update(1)
                 bar.finish()
             logger.info("Updated {:d}/{:d} granules".format(count_updated, count_all))
+        self._firstline_map = None
+        if self._firstline_cache is not None:
+            self._firstline_cache.cache_clear()
 
     def finalise(self, arr):
         return arr
@@ -467,14 +688,15 @@ class HIRSBestLineFilter(OverlapFilter):
              scanlines.size))
         return scanlines
 
-    def select_winner(self, rep):
+    def select_winner(self, rep, scores=None):
         """Select "winning" scanline among 2 or more
 
         Between 2 or more identical scanlines, select the one that fits
         best.  That probably means least flags etc.
 
         Takes a ndarray with dtype containing at least the HIRS flag
-        fields.  Dimension should be (n,) where n>1.
+        fields.  Dimension should be (n,) where n>1.  If the flag scores
+        for rep have already been calculated, pass them as scores.
 
         Returns the index of the best choice.
         """
@@ -489,7 +711,8 @@ class HIRSBestLineFilter(OverlapFilter):
         # But this differs between HIRS/2/3/4...
         # need some neutral way of "scoring" how bad it is
 
-        scores = self.ds.flagscore(rep)
+        if scores is None:
+            scores = self.ds.flagscore(rep)
         return numpy.argmin(scores)
 
     def finalise(self, arr, verify_overlap_consistency=False):
@@ -512,35 +735,55 @@ class HIRSBestLineFilter(OverlapFilter):
         # Find all pairs of duplicates (usually in sets of 2) and the
         # with corresponding indices and multiplicity (count).  
         arrsrt = arr[numpy.argsort(arr["time"])]
-        _, ii, cnt = numpy.unique(arrsrt["time"],
-            return_index=True, return_counts=True)
+        # arrsrt is sorted already, so rather than numpy.unique (which
+        # would sort again), find where each run of equal times starts.
+        # As in numpy.unique, all NaT times form one run, and so do all
+        # masked times, whatever their data.
+        t = numpy.ma.getdata(arrsrt["time"])
+        nat = numpy.isnat(t)
+        masked = numpy.ma.getmaskarray(arrsrt["time"])
+        newtime = numpy.empty(t.shape, dtype="?")
+        newtime[:1] = True
+        numpy.not_equal(t[1:], t[:-1], out=newtime[1:])
+        newtime[1:] &= ~(nat[1:] & nat[:-1])
+        newtime[1:] &= ~(masked[1:] & masked[:-1])
+        newtime[1:] |= masked[1:] != masked[:-1]
+        ii = newtime.nonzero()[0]
+        cnt = numpy.diff(numpy.append(ii, t.size))
         logger.debug("Selecting optimal scanlines for "
             f"{ii.size:d} overlapping pairs")
         # (mult_ii, mult_cnt) take the same values as if I were to do:
         # for (mult_ii, mult_cnt) in zip(ii[cnt>1], cnt[cnt>1]), but I
         # want to keep the indices so I can /write/ to ii
         multcnt_i_all = (cnt>1).nonzero()[0]
+        # calculating flag scores once for all scanlines is much cheaper
+        # than doing it again for each set of duplicates
+        if multcnt_i_all.size > 0:
+            scores = self.ds.flagscore(arrsrt)
         for multcnt_i in multcnt_i_all:
             mult_ii = ii[multcnt_i]
             mult_cnt = cnt[multcnt_i]
             rep = arrsrt[mult_ii:mult_ii+mult_cnt]
             if self.warn_overlap:
-                fields_notclose = {nm for nm in rep.dtype.names
+                fields_notclose = {nm for nm in
+                    set(rep.dtype.names) - self.knowndiff
                     if not
                     (rep[nm][0]==rep[nm]
                      if rep[nm].dtype.kind[0] in "MmS"
                      else numpy.isclose(rep[nm][0, ...], rep[nm])
-                    ).all()} - self.knowndiff
+                    ).all()}
                 if len(fields_notclose) > 0:
+                    # datetime64 formats itself, no need to convert
                     warnings.warn(
-                        "Overlapping or duplicate scanlines "
+                        "Overlapping or duplicate scanlines at {!s} "
                         "have inconsistent values for ".format(
-                            rep[0]["time"].astype(datetime.datetime))
+                            rep["time"][0])
                         + ", ".join(list(fields_notclose)),
                             UserWarning)
             # ii normally contains the index of the first of a sequence of
             # duplicates; select_winner returns the index of the optimal
             # choice within the set 'rep' of repeated scanlines; the sum
             # will thus be the index of our scanline of choice
-            ii[multcnt_i] += self.select_winner(rep)
+            ii[multcnt_i] += self.select_winner(rep,
+                scores[mult_ii:mult_ii+mult_cnt])
         return arrsrt[ii]
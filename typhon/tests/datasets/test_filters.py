@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Testing the filters in typhon.datasets.filters.
+"""
+import dbm
+import datetime
+import logging
+import concurrent.futures
+
+import numpy
+import pytest
+
+from typhon.datasets import dataset, filters
+
+
+class FakeHIRS:
+    """Minimal stand-in for a HIRS dataset."""
+    def get_dataname(self, header, robust=False):
+        return header["dataname"]
+
+    def flagscore(self, M):
+        return M["score"]
+
+
+class FakeHIRSGranules(FakeHIRS):
+    """Stand-in for a HIRS dataset with overlapping granules.
+
+    Granule k has scanlines 1 to 15 at times 10k to 10k+14 seconds.
+    Reading a granule whose number is in invalid fails; for those in
+    masked, the scanline numbers from 6 onwards are masked.
+    """
+    satname = "fake"
+    start_date = datetime.datetime(2010, 1, 1)
+    end_date = datetime.datetime(2010, 1, 2)
+
+    def __init__(self, n, invalid=(), masked=()):
+        self.n = n
+        self.invalid = invalid
+        self.masked = masked
+
+    def find_granules_sorted(self, start_date, end_date, return_time=False,
+                             satname=None):
+        for k in range(self.n):
+            yield (self.start_date + datetime.timedelta(seconds=10*k),
+                   "g{:d}".format(k))
+
+    def read(self, gran, apply_scale_factors=True, calibrate=True,
+             NO_CACHE=False):
+        k = int(gran[1:])
+        if k in self.invalid:
+            raise dataset.InvalidFileError("Cannot read {:s}".format(gran))
+        M = _scanlines(15)
+        M["time"] = numpy.datetime64(self.start_date, "ms")
+        M["time"] += (10*k + numpy.arange(15)) * 1000
+        if k in self.masked:
+            M["hrs_scnlin"].mask[5:] = True
+        return (M, {"header": {"dataname": gran}})
+
+    def _get_time(self, M):
+        return M["time"]
+
+
+def _scanlines(n):
+    """Masked structured array of n scanlines, numbered from 1."""
+    M = numpy.ma.zeros(n, dtype=[("hrs_scnlin", "i2"), ("temp_iwt", "f4"),
+                                 ("time", "M8[ms]")])
+    M["hrs_scnlin"] = numpy.arange(1, n+1)
+    M["temp_iwt"] = numpy.linspace(280, 290, n)
+    M.mask = False
+    return M
+
+
+def _cube_with_outliers():
+    """Masked (scanline, element, channel) cube and its known outliers.
+
+    Channel 2 is constant, such that its MAD is zero, and channel 3 is
+    entirely masked.
+    """
+    rng = numpy.random.RandomState(0)
+    C = numpy.ma.masked_array(rng.normal(1000, 10, size=(50, 8, 5)),
+                              mask=rng.uniform(size=(50, 8, 5)) < 0.1)
+    C[:, :, 2] = 500
+    C[:, :, 3] = numpy.ma.masked
+    outliers = numpy.zeros(C.shape, dtype="?")
+    outliers[[3, 10, 40], [0, 5, 7], [0, 1, 4]] = True
+    outliers[20, 2, 2] = True
+    C[outliers] = 2000
+    return (C, outliers | C.mask)
+
+
+class TestMEDMAD:
+    """Testing the MEDMAD outlier filter and its kernels."""
+    def test_known_outliers(self):
+        """Test that injected outliers and masked values are flagged."""
+        (C, expected) = _cube_with_outliers()
+        numpy.testing.assert_array_equal(
+            filters.MEDMAD(10).filter_outliers(C), expected)
+
+    @pytest.mark.parametrize("precision", [None, "f32", "f64"])
+    def test_dtypes(self, precision):
+        """Test integer and float32 input at each precision."""
+        (C, expected) = _cube_with_outliers()
+        flt = filters.MEDMAD(10, precision=precision)
+        for dtype in ("i4", "f4"):
+            numpy.testing.assert_array_equal(
+                flt.filter_outliers(C.astype(dtype)), expected)
+
+    def test_low_dimensional(self):
+        """Test that 1-D and 2-D input are treated as one channel."""
+        (C, _) = _cube_with_outliers()
+        C = C[:, :, 0]
+        expected = numpy.abs(C - numpy.ma.median(C)).filled(numpy.inf) > (
+            10 * numpy.ma.median(numpy.abs(C - numpy.ma.median(C))))
+        flt = filters.MEDMAD(10)
+        numpy.testing.assert_array_equal(flt.filter_outliers(C), expected)
+        numpy.testing.assert_array_equal(
+            flt.filter_outliers(C.ravel()), expected.ravel())
+        with pytest.raises(ValueError):
+            flt.filter_outliers(C.reshape(1, 1, 50, 8))
+
+    def test_threads(self):
+        """Test calling filter_outliers from several threads at once."""
+        (C, expected) = _cube_with_outliers()
+        flt = filters.MEDMAD(10)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            for out in executor.map(flt.filter_outliers, [C]*32):
+                numpy.testing.assert_array_equal(out, expected)
+
+    @pytest.mark.parametrize("dtype", ["f4", "f8"])
+    @pytest.mark.parametrize("shape", [(-1, 5), (-1, 1)])
+    def test_kernels_agree(self, dtype, shape):
+        """Test that the Numba and NumPy kernels give the same result."""
+        pytest.importorskip("numba")
+        (C, _) = _cube_with_outliers()
+        A = filters._nanfilled(C.reshape(shape), dtype)
+        outs = []
+        for kernel in (filters._mad_outliers_numpy, filters._mad_outliers):
+            outs.append(numpy.empty(A.shape, dtype="?"))
+            kernel(A, 10, 0.1, outs[-1])
+        numpy.testing.assert_array_equal(*outs)
+        assert outs[0].any() and not outs[0].all()
+
+
+class TestFirstlineDBFilter:
+    """Testing the FirstlineDBFilter."""
+    def _filter(self, firstline):
+        flt = filters.FirstlineDBFilter(FakeHIRS(), None)
+        flt._firstline_map = {"granule": firstline}
+        return flt
+
+    def test_filter(self):
+        """Test that scanlines up to firstline are removed."""
+        M = _scanlines(10)
+        flt = self._filter(3)
+        out = flt.filter(M, {"dataname": "granule"})
+        numpy.testing.assert_array_equal(out["hrs_scnlin"],
+                                         numpy.arange(4, 11))
+        out = flt.filter(M[::-1], {"dataname": "granule"})
+        numpy.testing.assert_array_equal(out["hrs_scnlin"],
+                                         numpy.arange(10, 3, -1))
+
+    def test_filter_leaves_source(self):
+        """Test that writing to the filtered lines leaves the source."""
+        M = _scanlines(10)
+        orig = M.copy()
+        out = self._filter(3).filter(M, {"dataname": "granule"})
+        out["temp_iwt"].mask[...] = True
+        out["temp_iwt"][...] = 0
+        numpy.testing.assert_array_equal(M.mask, orig.mask)
+        numpy.testing.assert_array_equal(M.data, orig.data)
+
+    @pytest.mark.parametrize("max_workers", [None, 1, 3])
+    def test_update_firstline_db(self, tmp_path, caplog, max_workers):
+        """Test the database contents, with and without reading ahead."""
+        gfl = tmp_path / "gfl.db"
+        flt = filters.FirstlineDBFilter(FakeHIRSGranules(6, invalid={3}), gfl)
+        with caplog.at_level(logging.ERROR, logger=filters.__name__):
+            flt.update_firstline_db(max_workers=max_workers)
+        assert "Could not read g3" in caplog.text
+        with dbm.open(str(gfl), "r") as gfd:
+            assert {k.decode(): int(gfd[k]) for k in gfd.keys()} == {
+                "g1": 6, "g2": 6, "g4": 1, "g5": 6}
+
+    @pytest.mark.parametrize("max_preload",
+                             [filters.FirstlineDBFilter.max_preload, 0])
+    def test_filter_from_db(self, tmp_path, max_preload):
+        """Test filtering with firstlines from the database on disk."""
+        flt = filters.FirstlineDBFilter(FakeHIRSGranules(4),
+                                        tmp_path / "gfl.db")
+        flt.max_preload = max_preload
+        flt.update_firstline_db()
+        (M, extra) = flt.ds.read("g2")
+        for _ in range(2):
+            out = flt.filter(M, extra["header"])
+            numpy.testing.assert_array_equal(out["hrs_scnlin"],
+                                             numpy.arange(7, 16))
+        if max_preload:
+            assert flt._firstline_map == {"g1": 6, "g2": 6, "g3": 6}
+            assert flt._firstline_db is None
+        else:
+            assert flt._firstline_map is None
+            info = flt._firstline_cache.cache_info()
+            assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+        with pytest.raises(filters.FilterError, match="g9"):
+            flt.filter(M, {"dataname": "g9"})
+        flt.update_firstline_db(overwrite=True)
+        assert flt._firstline_map is None
+        if not max_preload:
+            assert flt._firstline_cache.cache_info().currsize == 0
+        out = flt.filter(M, extra["header"])
+        numpy.testing.assert_array_equal(out["hrs_scnlin"],
+                                         numpy.arange(7, 16))
+
+    def test_update_firstline_db_masked(self, tmp_path, caplog):
+        """Test that no firstline is stored if the new ones are masked."""
+        gfl = tmp_path / "gfl.db"
+        flt = filters.FirstlineDBFilter(FakeHIRSGranules(3, masked={1}), gfl)
+        with caplog.at_level(logging.ERROR, logger=filters.__name__):
+            flt.update_firstline_db()
+        assert "g1: all scanline numbers after g0 are masked" in caplog.text
+        with dbm.open(str(gfl), "r") as gfd:
+            assert {k.decode(): int(gfd[k]) for k in gfd.keys()} == {
+                "g2": 6}
+
+
+class TestHIRSBestLineFilter:
+    """Testing the HIRSBestLineFilter."""
+    def test_finalise(self):
+        """Test that one line is kept for each duplicate time."""
+        M = numpy.ma.zeros(8, dtype=[("time", "M8[ms]"), ("score", "i4"),
+                                     ("id", "i4")])
+        M["time"] = numpy.datetime64("2010-01-01T00:00:00", "ms")
+        M["time"] += numpy.array([2, 0, 1, 2, 5, 0, 3, 4]) * 1000
+        M["time"][[1, 5]] = numpy.datetime64("NaT")
+        M["score"] = [1, 1, 0, 0, 0, 0, 1, 0]
+        M["id"] = numpy.arange(8)
+        M.mask = False
+        M["time"].mask[[4, 6]] = True
+        out = filters.HIRSBestLineFilter(FakeHIRS()).finalise(M)
+        # as numpy.unique, all masked times are one time, as are all NaT
+        numpy.testing.assert_array_equal(out["id"], [2, 3, 7, 4, 5])